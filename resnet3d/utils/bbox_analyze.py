@@ -2,69 +2,242 @@
 import nrrd
 import numpy as np
 import pandas as pd
+from scipy.ndimage import find_objects
+from tqdm import tqdm
 import os
 import sys
 import argparse
 import glob
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
 
-def analyze_bbox_from_nrrd(input_dir, output_csv):
+
+# nrrd 规范中 type 字段的各种写法到 numpy dtype 的映射
+_NRRD_TYPES = {
+    'int8': ('signed char', 'int8', 'int8_t'),
+    'uint8': ('uchar', 'unsigned char', 'uint8', 'uint8_t'),
+    'int16': ('short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'),
+    'uint16': ('ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'),
+    'int32': ('int', 'signed int', 'int32', 'int32_t'),
+    'uint32': ('uint', 'unsigned int', 'uint32', 'uint32_t'),
+    'int64': ('longlong', 'long long', 'long long int', 'signed long long', 'signed long long int',
+              'int64', 'int64_t'),
+    'uint64': ('ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'),
+    'float32': ('float',),
+    'float64': ('double',),
+}
+_NRRD_DTYPES = {alias: np.dtype(name) for name, aliases in _NRRD_TYPES.items() for alias in aliases}
+
+
+def _nrrd_dtype(header):
     """
-    功能一：分析 input 目录下所有 nrrd 文件的 bbox 距离
+    由 nrrd header 的 type 和 endian 字段得到 numpy dtype，无法确定时返回 None
     """
-    records = []
+    dtype = _NRRD_DTYPES.get(str(header.get('type', '')).strip().lower())
+    if dtype is None:
+        return None
+    if dtype.itemsize == 1:
+        return dtype
     
-    # 获取 input 目录下所有 nrrd 文件
+    endian = header.get('endian')
+    if endian == 'little':
+        return dtype.newbyteorder('<')
+    if endian == 'big':
+        return dtype.newbyteorder('>')
+    return None
+
+
+def _read_volume(mask_path):
+    """
+    读取 nrrd 数据，保持文件中的原始 dtype
+    未压缩（raw）且数据内嵌在文件中的 nrrd 直接内存映射，不在堆上分配完整体积
+    """
+    with open(mask_path, 'rb') as fh:
+        header = nrrd.read_header(fh)
+        data_offset = fh.tell()
+    
+    byte_skip = header.get('byte skip', header.get('byteskip', 0))
+    dtype = _nrrd_dtype(header)
+    if (header.get('encoding') == 'raw'
+            and dtype is not None
+            and header.get('data file', header.get('datafile')) is None
+            and header.get('line skip', header.get('lineskip', 0)) == 0
+            and byte_skip >= -1):
+        shape = tuple(int(n) for n in header['sizes'])
+        if byte_skip == -1:
+            # byte skip 为 -1 表示数据位于文件末尾
+            data_offset = os.path.getsize(mask_path) - dtype.itemsize * int(np.prod(shape))
+        else:
+            data_offset += byte_skip
+        # 与 nrrd.read 默认的 index_order='F' 保持一致
+        return np.memmap(mask_path, dtype=dtype, mode='r', offset=data_offset, shape=shape, order='F')
+    
+    data, _ = nrrd.read(mask_path)
+    return data
+
+
+def _read_mask(mask_path):
+    """
+    读取 mask 并立即转换为 bool（1 字节/体素），后续所有归约只扫描 1 字节宽的数据
+    """
+    # mask > 0 保留 nrrd.read 返回的 Fortran 内存布局，结果本身就是连续的，无需再复制
+    return _read_volume(mask_path) > 0
+
+
+def _list_nrrd_files(input_dir):
+    """
+    获取 input 目录下所有 nrrd 文件并按文件名排序，没有文件时退出
+    """
     nrrd_files = glob.glob(os.path.join(input_dir, "*.nrrd"))
     
     if not nrrd_files:
         print(f"Error: No NRRD files found in {input_dir}")
         sys.exit(1)
     
-    # 按文件名排序
+    # 按文件名排序（executor.map 保持输入顺序，结果同样按文件名排列）
     nrrd_files.sort()
-    
-    for mask_path in nrrd_files:
-        filename = os.path.basename(mask_path)
-        print(f"# processing {filename}")
-        
+    return nrrd_files
+
+
+def _parse_bbox_size(bbox_size):
+    """
+    解析 bbox_size，格式可能是 "x0,y0,z0" 或三个独立参数
+    """
+    if isinstance(bbox_size, str):
         try:
-            mask, _ = nrrd.read(mask_path)
-            
-            # 直接获取 mask 内的坐标索引
-            x_idx, y_idx, z_idx = np.where(mask > 0)
-            
-            if len(x_idx) == 0:
-                print(f"Warning: {filename} has no non-zero values")
-                continue
-            
-            x_min, x_max = np.min(x_idx), np.max(x_idx)
-            y_min, y_max = np.min(y_idx), np.max(y_idx)
-            z_min, z_max = np.min(z_idx), np.max(z_idx)
-            
-            # 计算最大距离
-            d_x = x_max - x_min
-            d_y = y_max - y_min
-            d_z = z_max - z_min
+            bbox_x, bbox_y, bbox_z = map(int, bbox_size.split(','))
+        except ValueError:
+            print(f"Error: Invalid bbox_size format. Expected format: 'x0,y0,z0' (e.g., '64,64,64')")
+            sys.exit(1)
+    else:
+        bbox_x, bbox_y, bbox_z = bbox_size
+    return bbox_x, bbox_y, bbox_z
+
+
+def _write_csv_batch(output_csv, df, first):
+    """
+    将一批结果写入 csv：第一批覆盖写入并带表头，之后追加
+    """
+    df.to_csv(output_csv, mode='w' if first else 'a', header=first, index=False)
+
+
+def _map_files(worker, nrrd_files, worker_args, store, flush, workers=None, batch_size=256):
+    """
+    在进程池中对每个文件执行 worker(mask_path, *worker_args)，主进程显示进度条并打印子进程返回的提示信息
+    第 i 个文件处理成功时调用 store(i, rec) 保存结果；每处理 batch_size 个文件（以及最后剩余的文件）
+    调用一次 flush(batch, valid, first) 写出结果，batch 为文件下标的 slice，valid 为该批次的有效标记，
+    first 表示是否为第一批；flush 为 None 时不分批写出
+    返回所有文件的有效标记（bool 数组）
+    """
+    n = len(nrrd_files)
+    valid = np.zeros(n, dtype=bool)
+    
+    flushed = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = executor.map(worker, nrrd_files, *(repeat(arg) for arg in worker_args), chunksize=4)
+        for i, (rec, message) in enumerate(tqdm(results, total=n)):
+            if rec is None:
+                # 通过 tqdm.write 输出，避免打乱进度条
+                tqdm.write(message)
+            else:
+                store(i, rec)
+                valid[i] = True
             
-            records.append({
-                "filename": filename,
-                "d_x": d_x, 
-                "d_y": d_y, 
-                "d_z": d_z,
-            })
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            continue
-    
-    if not records:
+            if flush is not None and i + 1 - flushed == batch_size:
+                batch = slice(flushed, i + 1)
+                flush(batch, valid[batch], flushed == 0)
+                flushed = i + 1
+    
+    if flush is not None and flushed < n:
+        batch = slice(flushed, n)
+        flush(batch, valid[batch], flushed == 0)
+    
+    return valid
+
+
+def _bbox_extents(mask):
+    """
+    返回 bool mask 非零区域三个方向的最大距离 (d_x, d_y, d_z)，mask 为空时返回 None
+    """
+    # find_objects 在一次 C 循环中得到非零区域的紧致 bbox（slice 元组），不生成坐标数组
+    slices = find_objects(mask.view(np.uint8), max_label=1)[0]
+    
+    if slices is None:
+        return None
+    
+    # 计算最大距离（slice 为左闭右开区间）
+    d_x = slices[0].stop - slices[0].start - 1
+    d_y = slices[1].stop - slices[1].start - 1
+    d_z = slices[2].stop - slices[2].start - 1
+    
+    return d_x, d_y, d_z
+
+
+def _process_bbox_one(mask_path):
+    """
+    单个文件的 bbox 距离计算（在子进程中执行），返回 ((d_x, d_y, d_z), None)
+    子进程不输出任何信息，失败或 mask 为空时返回 (None, 提示信息)，由主进程统一打印
+    """
+    filename = os.path.basename(mask_path)
+    
+    try:
+        extents = _bbox_extents(_read_mask(mask_path))
+        
+        if extents is None:
+            return None, f"Warning: {filename} has no non-zero values"
+        
+        return extents, None
+    except Exception as e:
+        return None, f"Error processing {filename}: {e}"
+
+
+def _bbox_frame(names, d_xyz, valid):
+    """
+    由预分配的列构建 bbox 结果 DataFrame，只保留 valid 为 True 的行
+    """
+    return pd.DataFrame({
+        "filename": names[valid],
+        "d_x": d_xyz[valid, 0],
+        "d_y": d_xyz[valid, 1],
+        "d_z": d_xyz[valid, 2],
+    })
+
+
+def analyze_bbox_from_nrrd(input_dir, output_csv, workers=None, batch_size=256):
+    """
+    功能一：分析 input 目录下所有 nrrd 文件的 bbox 距离
+    workers 为并行读取文件的进程数，默认为 CPU 核数
+    每处理 batch_size 个文件就把结果追加写入 csv，中途中断时已处理的结果不会丢失
+    """
+    # 获取 input 目录下所有 nrrd 文件
+    nrrd_files = _list_nrrd_files(input_dir)
+    
+    # 预分配定类型的列，最后一次性构建 DataFrame，避免逐条 dict 和类型推断
+    n = len(nrrd_files)
+    names = np.array([os.path.basename(p) for p in nrrd_files], dtype=object)
+    d_xyz = np.empty((n, 3), dtype=np.int32)
+    
+    def store(i, rec):
+        d_xyz[i] = rec
+    
+    def flush(batch, valid, first):
+        _write_csv_batch(output_csv, _bbox_frame(names[batch], d_xyz[batch], valid), first)
+    
+    valid = _map_files(_process_bbox_one, nrrd_files, (), store, flush, workers, batch_size)
+    
+    if not valid.any():
         print("Error: No valid records generated")
         sys.exit(1)
     
-    df = pd.DataFrame(records)
+    df = _bbox_frame(names, d_xyz, valid)
     print(f"\nProcessed {len(df)} files")
     print(df.head())
-    df.to_csv(output_csv, index=False)
     print(f"\nResults saved to: {output_csv}")
 
 
@@ -88,113 +261,175 @@ def calculate_percentiles(csv_file):
     print(f"\nStatistics for {len(df)} records:")
     print("=" * 60)
     
+    # 三列一起在 pandas 的 C 实现中聚合（自动跳过 NaN），不再逐列逐项计算
+    stats = df[required_cols].agg(['min', 'mean', 'median', 'max'])
+    quantiles = df[required_cols].quantile([0.95, 0.99])
+    
     for col in required_cols:
-        values = df[col].dropna()
-        p95 = np.percentile(values, 95)
-        p99 = np.percentile(values, 99)
-        mean_val = values.mean()
-        median_val = values.median()
-        min_val = values.min()
-        max_val = values.max()
-        
         print(f"\n{col}:")
-        print(f"  Min:     {min_val:.2f}")
-        print(f"  Mean:    {mean_val:.2f}")
-        print(f"  Median:  {median_val:.2f}")
-        print(f"  95th percentile: {p95:.2f}")
-        print(f"  99th percentile: {p99:.2f}")
-        print(f"  Max:     {max_val:.2f}")
+        print(f"  Min:     {stats.at['min', col]:.2f}")
+        print(f"  Mean:    {stats.at['mean', col]:.2f}")
+        print(f"  Median:  {stats.at['median', col]:.2f}")
+        print(f"  95th percentile: {quantiles.at[0.95, col]:.2f}")
+        print(f"  99th percentile: {quantiles.at[0.99, col]:.2f}")
+        print(f"  Max:     {stats.at['max', col]:.2f}")
 
 
-def analyze_crop_outside_voxels(input_dir, bbox_size, output_csv=None):
+if HAS_NUMBA:
+    # nrrd mask 常见的几种 dtype 直接传入 kernel，numba 在子进程中首次调用时按具体 dtype
+    # （以及 memmap 的只读数组）各编译一份，LLVM 按具体位宽生成比较循环，cache=True 复用编译结果；
+    # 不在 import 时预编译，否则会在主进程中提前初始化 numba 的线程层，fork 出的子进程可能卡死。
+    # bool mask 以 uint8 视图传入，其他 dtype 先转换为 bool
+    _KERNEL_DTYPES = ('uint8', 'int16', 'float32')
+    
+    # 文件级并行已由进程池完成，kernel 本身单线程运行，避免每个子进程再各开 CPU 核数个线程
+    @njit(cache=True)
+    def _crop_stats_kernel(mask, bbox_x, bbox_y, bbox_z):
+        """
+        两次遍历 mask 统计体素总数（mask > 0）和 crop 外体素数，不生成任何坐标数组或临时布尔数组
+        """
+        H, W, D = mask.shape
+        
+        # 第一遍：通过坐标求和计算重心
+        sx = 0
+        sy = 0
+        sz = 0
+        n = 0
+        for i in range(H):
+            for j in range(W):
+                for k in range(D):
+                    if mask[i, j, k] > 0:
+                        sx += i
+                        sy += j
+                        sz += k
+                        n += 1
+        
+        if n == 0:
+            return 0, 0
+        
+        center_x = sx / n
+        center_y = sy / n
+        center_z = sz / n
+        
+        crop_x_min = center_x - bbox_x / 2.0
+        crop_x_max = center_x + bbox_x / 2.0
+        crop_y_min = center_y - bbox_y / 2.0
+        crop_y_max = center_y + bbox_y / 2.0
+        crop_z_min = center_z - bbox_z / 2.0
+        crop_z_max = center_z + bbox_z / 2.0
+        
+        # 第二遍：统计 crop 范围外的体素
+        outside = 0
+        for i in range(H):
+            out_x = i < crop_x_min or i >= crop_x_max
+            for j in range(W):
+                out_xy = out_x or j < crop_y_min or j >= crop_y_max
+                for k in range(D):
+                    if mask[i, j, k] > 0:
+                        if out_xy or k < crop_z_min or k >= crop_z_max:
+                            outside += 1
+        
+        return n, outside
+
+
+def _mask_profiles(mask):
     """
-    功能三：统计给定 bbox 下，3D crop 之外的体素个数和百分比
-    以 mask 重心为中心进行 crop，统计 mask=1 但在 crop 范围外的体素
+    返回 bool mask 沿三个方向的投影（每个切片内的体素个数），只需两次完整扫描
     """
-    records = []
+    p_xy = mask.sum(axis=2)
+    return p_xy.sum(axis=1), p_xy.sum(axis=0), mask.sum(axis=(0, 1))
+
+
+def _crop_stats_profiles(mask, profiles, bbox):
+    """
+    numpy 实现：返回 (体素总数, crop 外体素数)，不生成任何坐标数组
+    由投影与坐标的点积得到重心，crop 内的体素个数直接在 crop 子块上统计
+    """
+    total_voxels = int(profiles[0].sum())
     
-    # 解析 bbox_size，格式可能是 "x0,y0,z0" 或三个独立参数
-    if isinstance(bbox_size, str):
-        try:
-            bbox_x, bbox_y, bbox_z = map(int, bbox_size.split(','))
-        except ValueError:
-            print(f"Error: Invalid bbox_size format. Expected format: 'x0,y0,z0' (e.g., '64,64,64')")
-            sys.exit(1)
-    else:
-        bbox_x, bbox_y, bbox_z = bbox_size
+    if total_voxels == 0:
+        return 0, 0
     
-    print(f"Bounding box size: ({bbox_x}, {bbox_y}, {bbox_z})")
-    print(f"Processing files in: {input_dir}\n")
+    # 计算 mask 的重心（质心），crop 以重心为中心
+    center = np.array([p @ np.arange(len(p)) for p in profiles]) / total_voxels
+    half = np.array(bbox) / 2.0
     
-    # 获取 input 目录下所有 nrrd 文件
-    nrrd_files = glob.glob(os.path.join(input_dir, "*.nrrd"))
+    # 坐标为整数，x >= c 等价于 x >= ceil(c)，x < c 等价于 x < ceil(c)，
+    # 因此 crop 边界可以取整，再裁剪到体积范围内作为切片下标
+    shape = np.array(mask.shape)
+    crop_min = np.clip(np.ceil(center - half).astype(np.int64), 0, shape)
+    crop_max = np.clip(np.ceil(center + half).astype(np.int64), crop_min, shape)
     
-    if not nrrd_files:
-        print(f"Error: No NRRD files found in {input_dir}")
-        sys.exit(1)
+    inside_voxels = np.count_nonzero(mask[crop_min[0]:crop_max[0],
+                                          crop_min[1]:crop_max[1],
+                                          crop_min[2]:crop_max[2]])
     
-    # 按文件名排序
-    nrrd_files.sort()
+    return total_voxels, total_voxels - int(inside_voxels)
+
+
+def _crop_stats(mask, bbox):
+    """
+    返回 (体素总数, crop 外体素数)，安装了 numba 时使用编译后的 kernel
+    mask 可以是 bool mask，也可以是 _read_volume 读取的原始数据（此时以 > 0 判定）；
+    原始 dtype 有对应 kernel 时直接传入，省去转换 bool 的一次完整扫描
+    """
+    if not HAS_NUMBA:
+        if mask.dtype != np.bool_:
+            mask = mask > 0
+        return _crop_stats_profiles(mask, _mask_profiles(mask), bbox)
+    
+    # memmap 转为普通 ndarray 视图（不复制）
+    mask = np.asarray(mask)
+    if mask.dtype == np.bool_:
+        mask = mask.view(np.uint8)
+    elif mask.dtype.name not in _KERNEL_DTYPES or not mask.dtype.isnative:
+        mask = (mask > 0).view(np.uint8)
+    
+    bbox_x, bbox_y, bbox_z = bbox
+    # nrrd 数据默认是 Fortran 序数组，转置后按内存顺序遍历；
+    # crop 外的判定对各轴对称，交换轴顺序和 bbox 顺序即可得到相同结果
+    if mask.flags.f_contiguous and not mask.flags.c_contiguous:
+        return _crop_stats_kernel(mask.T, bbox_z, bbox_y, bbox_x)
+    return _crop_stats_kernel(np.ascontiguousarray(mask), bbox_x, bbox_y, bbox_z)
+
+
+def _process_crop_one(mask_path, bbox):
+    """
+    单个文件的 crop 外体素统计（在子进程中执行），返回 ((体素总数, crop 外体素数), None)
+    子进程不输出任何信息，失败或 mask 为空时返回 (None, 提示信息)，由主进程统一打印
+    """
+    filename = os.path.basename(mask_path)
     
-    for mask_path in nrrd_files:
-        filename = os.path.basename(mask_path)
-        print(f"# processing {filename}")
+    try:
+        total_voxels, outside_voxels = _crop_stats(_read_volume(mask_path), bbox)
         
-        try:
-            mask, _ = nrrd.read(mask_path)
-            
-            # 获取 mask 内所有体素的坐标（mask > 0）
-            x_idx, y_idx, z_idx = np.where(mask > 0)
-            
-            if len(x_idx) == 0:
-                print(f"Warning: {filename} has no non-zero values")
-                continue
-            
-            # 计算 mask 的重心（质心）
-            center_x = np.mean(x_idx)
-            center_y = np.mean(y_idx)
-            center_z = np.mean(z_idx)
-            
-            # 计算 crop 的边界（以重心为中心）
-            half_x = bbox_x / 2.0
-            half_y = bbox_y / 2.0
-            half_z = bbox_z / 2.0
-            
-            crop_x_min = center_x - half_x
-            crop_x_max = center_x + half_x
-            crop_y_min = center_y - half_y
-            crop_y_max = center_y + half_y
-            crop_z_min = center_z - half_z
-            crop_z_max = center_z + half_z
-            
-            # 统计在 crop 范围外的体素
-            # 体素在 crop 外：x < crop_x_min 或 x >= crop_x_max，y 和 z 同理
-            outside_mask = (
-                (x_idx < crop_x_min) | (x_idx >= crop_x_max) |
-                (y_idx < crop_y_min) | (y_idx >= crop_y_max) |
-                (z_idx < crop_z_min) | (z_idx >= crop_z_max)
-            )
-            
-            total_voxels = len(x_idx)
-            outside_voxels = np.sum(outside_mask)
-            outside_percentage = (outside_voxels / total_voxels * 100) if total_voxels > 0 else 0.0
-            
-            records.append({
-                "filename": filename,
-                "total_voxels": total_voxels,
-                "outside_voxels": outside_voxels,
-                "outside_percentage": outside_percentage
-            })
-            
-            print(f"  Total voxels: {total_voxels}, Outside: {outside_voxels} ({outside_percentage:.2f}%)")
-            
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            continue
+        if total_voxels == 0:
+            return None, f"Warning: {filename} has no non-zero values"
         
-    df = pd.DataFrame(records)
-    
-    # 打印汇总统计
+        return (total_voxels, outside_voxels), None
+        
+    except Exception as e:
+        return None, f"Error processing {filename}: {e}"
+
+
+def _crop_frame(names, counts, valid):
+    """
+    由预分配的列构建 crop 结果 DataFrame，只保留 valid 为 True 的行
+    """
+    total_voxels = counts[valid, 0]
+    outside_voxels = counts[valid, 1]
+    return pd.DataFrame({
+        "filename": names[valid],
+        "total_voxels": total_voxels,
+        "outside_voxels": outside_voxels,
+        "outside_percentage": outside_voxels / total_voxels * 100,
+    })
+
+
+def _print_crop_summary(df):
+    """
+    打印 crop 外体素统计的汇总信息
+    """
     print(f"\n{'='*60}")
     print(f"Summary for {len(df)} files:")
     print(f"{'='*60}")
@@ -207,13 +442,117 @@ def analyze_crop_outside_voxels(input_dir, bbox_size, output_csv=None):
     
     print(f"\nProcessed {len(df)} files")
     print(df.head())
+
+
+def analyze_crop_outside_voxels(input_dir, bbox_size, output_csv=None, workers=None, batch_size=256):
+    """
+    功能三：统计给定 bbox 下，3D crop 之外的体素个数和百分比
+    以 mask 重心为中心进行 crop，统计 mask=1 但在 crop 范围外的体素
+    workers 为并行读取文件的进程数，默认为 CPU 核数
+    指定 output_csv 时每处理 batch_size 个文件就把结果追加写入 csv
+    """
+    bbox = _parse_bbox_size(bbox_size)
+    
+    print(f"Bounding box size: {bbox}")
+    print(f"Processing files in: {input_dir}\n")
+    
+    # 获取 input 目录下所有 nrrd 文件
+    nrrd_files = _list_nrrd_files(input_dir)
+    
+    # 预分配定类型的列，最后一次性构建 DataFrame，避免逐条 dict 和类型推断
+    n = len(nrrd_files)
+    names = np.array([os.path.basename(p) for p in nrrd_files], dtype=object)
+    counts = np.empty((n, 2), dtype=np.int64)
+    
+    def store(i, rec):
+        counts[i] = rec
+    
+    def flush(batch, valid, first):
+        _write_csv_batch(output_csv, _crop_frame(names[batch], counts[batch], valid), first)
+    
+    valid = _map_files(_process_crop_one, nrrd_files, (bbox,), store, flush if output_csv else None,
+                       workers, batch_size)
     
-    # 保存到 CSV（如果指定了输出文件）
+    df = _crop_frame(names, counts, valid)
+    _print_crop_summary(df)
+    
+    # 结果已在处理过程中分批写入 CSV（如果指定了输出文件）
     if output_csv:
-        df.to_csv(output_csv, index=False)
         print(f"\nResults saved to: {output_csv}")
 
 
+def _process_all_one(mask_path, bbox):
+    """
+    单个文件只读取一次，同时计算 bbox 距离和 crop 外体素统计（在子进程中执行）
+    返回 ((d_x, d_y, d_z, 体素总数, crop 外体素数), None)，失败或 mask 为空时返回 (None, 提示信息)
+    """
+    filename = os.path.basename(mask_path)
+    
+    try:
+        mask = _read_mask(mask_path)
+        
+        if HAS_NUMBA:
+            extents = _bbox_extents(mask)
+            
+            if extents is None:
+                return None, f"Warning: {filename} has no non-zero values"
+            
+            return extents + _crop_stats(mask, bbox), None
+        
+        # numpy 路径计算重心时本来就要得到三个方向的投影，bbox 距离即为投影中
+        # 首个和最后一个非零切片的间隔，省去 find_objects 对整个体积的再次扫描
+        profiles = _mask_profiles(mask)
+        
+        if profiles[0].sum() == 0:
+            return None, f"Warning: {filename} has no non-zero values"
+        
+        extents = tuple(int(nz[-1] - nz[0]) for nz in map(np.flatnonzero, profiles))
+        return extents + _crop_stats_profiles(mask, profiles, bbox), None
+        
+    except Exception as e:
+        return None, f"Error processing {filename}: {e}"
+
+
+def analyze_all(input_dir, bbox_size, bbox_csv, crop_csv, workers=None, batch_size=256):
+    """
+    功能四：一次遍历同时完成功能一和功能三，每个 nrrd 文件只读取、解压一次
+    bbox 距离写入 bbox_csv，crop 外体素统计写入 crop_csv
+    """
+    bbox = _parse_bbox_size(bbox_size)
+    
+    print(f"Bounding box size: {bbox}")
+    print(f"Processing files in: {input_dir}\n")
+    
+    # 获取 input 目录下所有 nrrd 文件
+    nrrd_files = _list_nrrd_files(input_dir)
+    
+    # 预分配定类型的列，最后一次性构建 DataFrame，避免逐条 dict 和类型推断
+    n = len(nrrd_files)
+    names = np.array([os.path.basename(p) for p in nrrd_files], dtype=object)
+    d_xyz = np.empty((n, 3), dtype=np.int32)
+    counts = np.empty((n, 2), dtype=np.int64)
+    
+    def store(i, rec):
+        d_xyz[i] = rec[:3]
+        counts[i] = rec[3:]
+    
+    def flush(batch, valid, first):
+        _write_csv_batch(bbox_csv, _bbox_frame(names[batch], d_xyz[batch], valid), first)
+        _write_csv_batch(crop_csv, _crop_frame(names[batch], counts[batch], valid), first)
+    
+    valid = _map_files(_process_all_one, nrrd_files, (bbox,), store, flush, workers, batch_size)
+    
+    if not valid.any():
+        print("Error: No valid records generated")
+        sys.exit(1)
+    
+    print(_bbox_frame(names, d_xyz, valid).head())
+    _print_crop_summary(_crop_frame(names, counts, valid))
+    
+    print(f"\nBbox results saved to: {bbox_csv}")
+    print(f"Crop results saved to: {crop_csv}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Bounding box analysis tool for NRRD files')
     subparsers = parser.add_subparsers(dest='mode', help='Operation mode')
@@ -222,6 +561,8 @@ if __name__ == "__main__":
     parser_analyze = subparsers.add_parser('analyze', help='Analyze bbox distances from NRRD files in input directory')
     parser_analyze.add_argument('input_dir', type=str, help='Input directory containing NRRD files')
     parser_analyze.add_argument('output_csv', type=str, help='Output CSV file path')
+    parser_analyze.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser_analyze.add_argument('--batch_size', type=int, default=256, help='Number of files per CSV write batch (default: 256)')
     
     # 功能二：计算百分位数
     parser_percentile = subparsers.add_parser('percentile', help='Calculate percentiles from CSV file')
@@ -232,6 +573,17 @@ if __name__ == "__main__":
     parser_crop.add_argument('input_dir', type=str, help='Input directory containing NRRD files')
     parser_crop.add_argument('bbox_size', type=str, help='Bounding box size in format "x0,y0,z0" (e.g., "64,64,64")')
     parser_crop.add_argument('--output_csv', type=str, default=None, help='Optional output CSV file path')
+    parser_crop.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser_crop.add_argument('--batch_size', type=int, default=256, help='Number of files per CSV write batch (default: 256)')
+    
+    # 功能四：一次遍历同时完成功能一和功能三
+    parser_all = subparsers.add_parser('analyze_all', help='Compute bbox distances and crop outside voxels in a single pass')
+    parser_all.add_argument('input_dir', type=str, help='Input directory containing NRRD files')
+    parser_all.add_argument('bbox_size', type=str, help='Bounding box size in format "x0,y0,z0" (e.g., "64,64,64")')
+    parser_all.add_argument('bbox_csv', type=str, help='Output CSV file path for bbox distances')
+    parser_all.add_argument('crop_csv', type=str, help='Output CSV file path for crop outside voxels')
+    parser_all.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser_all.add_argument('--batch_size', type=int, default=256, help='Number of files per CSV write batch (default: 256)')
     
     args = parser.parse_args()
     
@@ -239,14 +591,19 @@ if __name__ == "__main__":
         if not os.path.isdir(args.input_dir):
             print(f"Error: Input directory does not exist: {args.input_dir}")
             sys.exit(1)
-        analyze_bbox_from_nrrd(args.input_dir, args.output_csv)
+        analyze_bbox_from_nrrd(args.input_dir, args.output_csv, args.workers, args.batch_size)
     elif args.mode == 'percentile':
         calculate_percentiles(args.csv_file)
     elif args.mode == 'crop':
         if not os.path.isdir(args.input_dir):
             print(f"Error: Input directory does not exist: {args.input_dir}")
             sys.exit(1)
-        analyze_crop_outside_voxels(args.input_dir, args.bbox_size, args.output_csv)
+        analyze_crop_outside_voxels(args.input_dir, args.bbox_size, args.output_csv, args.workers, args.batch_size)
+    elif args.mode == 'analyze_all':
+        if not os.path.isdir(args.input_dir):
+            print(f"Error: Input directory does not exist: {args.input_dir}")
+            sys.exit(1)
+        analyze_all(args.input_dir, args.bbox_size, args.bbox_csv, args.crop_csv, args.workers, args.batch_size)
     else:
         parser.print_help()
         sys.exit(1)
\ No newline at end of file
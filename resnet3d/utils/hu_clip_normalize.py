@@ -7,15 +7,18 @@ import argparse
 
 def hu_clip_normalize(input_file, output_dir):
     data, header = nrrd.read(input_file)
-    data_clipped = np.clip(data, -1000, 400)
-    data_normalized = (data_clipped + 1000) / 1400
+    # 直接裁剪到 float32 输出缓冲区，再原地归一化，避免中间数组和 float64 提升
+    out = np.empty_like(data, dtype=np.float32)
+    np.clip(data, -1000, 400, out=out, casting='unsafe')
+    out += 1000.0
+    out *= 1.0 / 1400.0
     
     os.makedirs(output_dir, exist_ok=True)
 
     filename = os.path.basename(input_file)
     output_path = os.path.join(output_dir, filename)
 
-    nrrd.write(output_path, data_normalized, header)
+    nrrd.write(output_path, out, header)
     print(f"Saved to: {output_path}")
 
 if __name__ == "__main__":